@@ -1,34 +1,65 @@
+import functools
+import hashlib
 import itertools
 import json
-from collections import defaultdict
-from dataclasses import dataclass
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 from pathlib import Path
-from typing import Any, DefaultDict, Dict, List, TypedDict
+from typing import Any, Dict, Iterable, List, NamedTuple, Tuple, TypedDict
 
+import numpy as np
 import requests
 from PIL import Image
+from requests.adapters import HTTPAdapter
 
 IMAGE_FOLDER = Path("./img/")
 DATA_FOLDER = Path("./data/")
+CACHE_FOLDER = Path("./cache/")
 TILE_SIZE = 40
-
-WATER_EDGE_CANCELERS = [
-    # if water tiles ("wtr") are adjacent to one of these, there will not be an edge between them
-    "wtr",
-    # these are from the Faerieland level
-    "cld",
-    "scld",
-    "fc_1",
-    "fc_2",
-    "fc_3",
-    "fc_4",
-    "fc_6",
-    "fc_7",
-    "fc_8",
-    "fc_9",
-    # haven't found any other edge cases, no pun intended
-]
+DOWNLOAD_WORKERS = 16  # how many missing tiles get downloaded at once
+RENDER_VERSION = 1  # bump when a change to the renderer or to the tile images changes renders, so older cached ones aren't used
+
+WATER_EDGE_CANCELERS = frozenset(
+    {
+        # if water tiles ("wtr") are adjacent to one of these, there will not be an edge between them
+        "wtr",
+        # these are from the Faerieland level
+        "cld",
+        "scld",
+        "fc_1",
+        "fc_2",
+        "fc_3",
+        "fc_4",
+        "fc_6",
+        "fc_7",
+        "fc_8",
+        "fc_9",
+        # haven't found any other edge cases, no pun intended
+    }
+)
+
+# the sprite suffix of a water tile ("wtr_" + suffix) for each combination of its edges
+# indexed by a code where N, S, E, W are the bits from lowest to highest. no edges is just "wtr"
+WATER_EDGE_SUFFIXES = (
+    "",
+    "n",
+    "s",
+    "ns",
+    "e",
+    "ne",
+    "se",
+    "nse",
+    "w",
+    "nw",
+    "sw",
+    "nsw",
+    "ew",
+    "new",
+    "sew",
+    "nsew",
+)
 
 
 class Map(TypedDict):
@@ -44,8 +75,62 @@ class Map(TypedDict):
     layers: List[List[str]]
 
 
-@dataclass
-class RenderTile:
+def _download_tile(img: Path, session: Any = requests) -> None:
+    """Downloads the image of a tile to the given path, named after it."""
+    response = session.get(f"https://images.neopets.com/nq2/t/{img.name}")
+    # so an error page never gets saved as the tile
+    response.raise_for_status()
+    img.write_bytes(response.content)
+
+
+def _download_tiles(tile_names: Iterable[str]) -> None:
+    """Downloads every given tile that doesn't exist yet, at the same time, over one pooled session."""
+    missing = [
+        img
+        for img in (IMAGE_FOLDER / f"{tile_name}.gif" for tile_name in tile_names)
+        if not img.exists()
+    ]
+    if not missing:
+        return
+
+    with requests.Session() as session:
+        # keep a connection alive per worker, instead of a new one per tile
+        session.mount(
+            "https://",
+            HTTPAdapter(pool_connections=1, pool_maxsize=DOWNLOAD_WORKERS),
+        )
+        with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+            # list() so any download errors get raised here
+            list(executor.map(_download_tile, missing, itertools.repeat(session)))
+
+
+@functools.lru_cache(maxsize=None)
+def _load_tile(tile_name: str) -> Image.Image:
+    """Returns the decoded RGBA image of a tile, by its url name. Only hits the disk (or network) once per tile."""
+    img = IMAGE_FOLDER / f"{tile_name}.gif"
+
+    # download it if it doesn't exist
+    if not img.exists():
+        _download_tile(img)
+
+    # decode it once, in the mode everything gets pasted in anyway
+    with Image.open(img) as image:
+        return image.convert("RGBA")
+
+
+@functools.lru_cache(maxsize=None)
+def _load_tile_array(tile_name: str) -> np.ndarray:
+    """Returns the pixels of a tile as a read-only (TILE_SIZE, TILE_SIZE, 4) array."""
+    return np.asarray(_load_tile(tile_name))
+
+
+@functools.lru_cache(maxsize=None)
+def _is_tile_opaque(tile_name: str) -> bool:
+    """Returns whether a tile has no see-through pixels at all."""
+    return bool((_load_tile_array(tile_name)[..., 3] == 255).all())
+
+
+class RenderTile(NamedTuple):
     x: int
     y: int
     z: int
@@ -53,6 +138,60 @@ class RenderTile:
     out_of_bounds: bool = False
 
 
+class RenderLayer(TypedDict):
+    # the tiles of a layer as parallel arrays, one entry per tile
+    x: np.ndarray
+    y: np.ndarray
+    tile_id: np.ndarray  # index into MapRenderer.tile_names_by_id
+    out_of_bounds: np.ndarray
+
+
+def _make_layer(
+    x: np.ndarray, y: np.ndarray, tile_id: np.ndarray, out_of_bounds: bool = False
+) -> RenderLayer:
+    """Returns a layer from the x and y, in the image, and tile ids of its tiles."""
+    return RenderLayer(
+        x=x, y=y, tile_id=tile_id, out_of_bounds=np.full(len(x), out_of_bounds)
+    )
+
+
+def _join_layers(*layers: RenderLayer) -> RenderLayer:
+    """Returns the tiles of all the given layers as one layer."""
+    return RenderLayer(
+        x=np.concatenate([layer["x"] for layer in layers]),
+        y=np.concatenate([layer["y"] for layer in layers]),
+        tile_id=np.concatenate([layer["tile_id"] for layer in layers]),
+        out_of_bounds=np.concatenate([layer["out_of_bounds"] for layer in layers]),
+    )
+
+
+def classify_water(
+    cancelers: np.ndarray, water_tile_ids: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the water tile id and the NW, SW, SE, NE caps of every tile of a layer, from whether each of its tiles cancels water edges."""
+    # a tile gets an edge on every side whose neighbor doesn't cancel water edges, and a cap on every such diagonal
+    # water_tile_ids maps the NSEW edges of a water tile, as bits from lowest to highest, to the id of its sprite
+    # out of bounds neighbors are assumed to be water, so they never make an edge or a cap
+    edges = ~np.pad(cancelers, 1, constant_values=True)
+
+    # N, S, E, W neighbors as the bits of a 0-15 code
+    edge_codes = (
+        edges[:-2, 1:-1] * 1
+        | edges[2:, 1:-1] * 2
+        | edges[1:-1, 2:] * 4
+        | edges[1:-1, :-2] * 8
+    )
+    caps = np.stack(
+        (
+            edges[:-2, :-2],  # NW
+            edges[2:, :-2],  # SW
+            edges[2:, 2:],  # SE
+            edges[:-2, 2:],  # NE
+        )
+    )
+    return np.take(water_tile_ids, edge_codes), caps
+
+
 class MapRenderer:
     def __init__(
         self,
@@ -64,7 +203,11 @@ class MapRenderer:
         render_water_edges: bool = True,
     ) -> None:
 
-        self.map: Map = json.loads((DATA_FOLDER / f"{map_id}.json").read_text())
+        self.map_id = map_id
+        map_path = DATA_FOLDER / f"{map_id}.json"
+        self.map: Map = json.loads(map_path.read_text())
+        # so renders cached before the map was changed aren't used
+        self._map_mtime = map_path.stat().st_mtime_ns
 
         self.rows = len(self.map["layers"][0])
         self.cols = len(self.map["layers"][0][0])
@@ -78,23 +221,99 @@ class MapRenderer:
 
         self.render_water_edges = render_water_edges
 
-    def get_tile(self, tile_type: str) -> Image.Image:
-        """Returns an image of the tile at the given location."""
+        # resolved once here, these get looked up for just about every tile
+        self._tile_names: Dict[str, str] = dict(self.map["tiles"])
+        self._default_tile_name = self.get_tile_name(self.map["default"])
 
-        tile = self.map["tiles"].get(tile_type)
-        if tile:
-            img = IMAGE_FOLDER / f"{tile}.gif"
-        else:
-            # for when we don't have it hardcoded
-            # like for water edges
-            img = IMAGE_FOLDER / f"{tile_type}.gif"
-
-        # download it if it doesn't exist
-        if not img.exists():
-            img.write_bytes(
-                requests.get(f"https://images.neopets.com/nq2/t/{img.name}").content
+        # every character used in the map's layers, besides the blank " "
+        map_keys = sorted(
+            {tile for layer in self.map["layers"] for row in layer for tile in row}
+            - {" "}
+        )
+
+        # every tile the map itself draws. characters that aren't in the map's tiles are url names themselves,
+        # and so can the default and the border be
+        map_tile_names = list(
+            dict.fromkeys(
+                [
+                    *self._tile_names.values(),
+                    *(self.get_tile_name(tile) for tile in map_keys),
+                    self._default_tile_name,
+                    self.get_tile_name(self.map["border"]),
+                ]
             )
-        return Image.open(img)
+        )
+
+        # every tile that can end up in a render, by id. water edges and caps aren't in the map's tiles
+        self.tile_names_by_id: List[str] = list(
+            dict.fromkeys(
+                [
+                    *map_tile_names,
+                    *(
+                        f"wtr_{suffix}" if suffix else "wtr"
+                        for suffix in WATER_EDGE_SUFFIXES
+                    ),
+                    *(f"wtrc_{corner}" for corner in "abcd"),
+                ]
+            )
+        )
+        self._tile_ids = {name: i for i, name in enumerate(self.tile_names_by_id)}
+        # the water sprite ids, in the order of WATER_EDGE_SUFFIXES
+        self._water_tile_ids = np.array(
+            [
+                self._tile_ids[f"wtr_{suffix}" if suffix else "wtr"]
+                for suffix in WATER_EDGE_SUFFIXES
+            ]
+        )
+
+        # the map's layers as one (layers, rows, cols) array of tile ids, instead of characters.
+        # blank tiles, the default tile that doesn't get drawn, get an id past all the others
+        self._blank_id = len(self.tile_names_by_id)
+        key_ids = {tile: self.get_tile_id(tile) for tile in map_keys}
+        key_ids[" "] = self._blank_id
+        self._grid = np.array(
+            [
+                [[key_ids[tile] for tile in row] for row in layer]
+                for layer in self.map["layers"]
+            ],
+            dtype=np.min_scalar_type(self._blank_id),
+        )
+
+        # whether each tile id of the grid cancels water edges, by indexing this with it.
+        # decided by the map's character, ones that aren't in its tiles count as the default tile here
+        self._cancels_water = np.zeros(self._blank_id + 1, dtype=bool)
+        for tile, tile_id in key_ids.items():
+            self._cancels_water[tile_id] = (
+                self._tile_names.get(tile, self._default_tile_name)
+                in WATER_EDGE_CANCELERS
+            )
+
+    def get_tile_name(self, tile_type: str) -> str:
+        """Returns the url name of a tile, from either its key in the map's tiles or the url name itself."""
+        # for when we don't have it hardcoded, like for water edges, it's already the url name
+        return self._tile_names.get(tile_type, tile_type)
+
+    def get_tile(self, tile_type: str) -> Image.Image:
+        """Returns an image of the tile at the given location."""
+        # a copy, the cached one is shared by every render
+        return _load_tile(self.get_tile_name(tile_type)).copy()
+
+    def get_tile_array(self, tile_type: str) -> np.ndarray:
+        """Returns the RGBA pixels of a tile, as an array."""
+        return _load_tile_array(self.get_tile_name(tile_type))
+
+    def get_tile_id(self, tile_type: str) -> int:
+        """Returns the id of a tile, the index of its url name in tile_names_by_id."""
+        return self._tile_ids[self.get_tile_name(tile_type)]
+
+    def download_tiles(self, tile_ids: Iterable[int]) -> None:
+        """Downloads the given tiles, by id, and the default tile, that don't exist yet, in one go."""
+        _download_tiles(
+            [
+                self._default_tile_name,
+                *(self.tile_names_by_id[tile_id] for tile_id in tile_ids),
+            ]
+        )
 
     def get_tile_at(self, *, x: int, y: int, z: int = 0) -> RenderTile:
         """Returns a tile at the given location."""
@@ -104,166 +323,221 @@ class MapRenderer:
             x, y, z, tile=self.map["layers"][z][y][x], out_of_bounds=False
         )
 
-    def get_neighbors(self, *, x: int, y: int, z: int = 0) -> List[RenderTile]:
-        """Returns the neighbors of the tile at the given location in NSEW order. Only used for water edges."""
-        neighbors: List[RenderTile] = [
-            # add north neighbor
-            self.get_tile_at(x=x, y=y - 1, z=z),
-            # add south neighbor
-            self.get_tile_at(x=x, y=y + 1, z=z),
-            # add east neighbor
-            self.get_tile_at(x=x + 1, y=y, z=z),
-            # add west neighbor
-            self.get_tile_at(x=x - 1, y=y, z=z),
-            # add north-west neighbor
-            self.get_tile_at(x=x - 1, y=y - 1, z=z),
-            # add south-west neighbor
-            self.get_tile_at(x=x - 1, y=y + 1, z=z),
-            # add south-east neighbor
-            self.get_tile_at(x=x + 1, y=y + 1, z=z),
-            # add north-east neighbor
-            self.get_tile_at(x=x + 1, y=y - 1, z=z),
-        ]
-        return neighbors
+    def get_water_edges(self, *, z: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the water tile id and the NW, SW, SE, NE caps for every tile of a layer, in one go. Only used for water edges."""
+        cancelers = self._cancels_water[self._grid[z]]
+        return classify_water(cancelers, self._water_tile_ids)
+
+    def get_bounds(self, *, full_map: bool = False) -> Tuple[int, int, int, int]:
+        """Returns the x origin, y origin, x max and y max of the part of the map that gets rendered."""
+        if full_map:
+            return 0, 0, self.cols, self.rows
+        return (
+            -self.radius + self.x,
+            -self.radius + self.y,
+            self.radius + self.x + 1,
+            self.radius + self.y + 1,
+        )
+
+    def map_layer(
+        self, *, z: int, full_map: bool = False
+    ) -> Tuple[RenderLayer, List[RenderLayer]]:
+        """Generates the tiles of a single layer of the map, and the water edge caps that go on top of them, per corner."""
+        x_origin, y_origin, _, _ = self.get_bounds(full_map=full_map)
+        border, y, x, tile_ids = self._map_layer_tiles(z=z, full_map=full_map)
+
+        x_out = (x - x_origin) * TILE_SIZE
+        y_out = (y - y_origin) * TILE_SIZE
+
+        if not self.render_water_edges:
+            return _join_layers(border, _make_layer(x_out, y_out, tile_ids)), []
+
+        water_ids, water_caps = self.get_water_edges(z=z)
+
+        # special cases for water edges
+        is_water = tile_ids == self.get_tile_id("wtr")
+        tile_ids = np.where(is_water, water_ids[y, x], tile_ids)
+
+        # the following is for the "caps" of water edges
+        # for example, if the tile we're currently on is water, and there's a water tile both to the east and south,
+        # then we'll put a cap where those edges meet to have a clean look, just like NQ2 does!
+        caps: List[RenderLayer] = []
+        # NW, SW, SE, NE in that order
+        for corner_caps, edge_letter in zip(water_caps, "acdb"):
+            capped = is_water & corner_caps[y, x]
+            caps.append(
+                _make_layer(
+                    x_out[capped],
+                    y_out[capped],
+                    np.full(capped.sum(), self.get_tile_id(f"wtrc_{edge_letter}")),
+                )
+            )
+
+        return _join_layers(border, _make_layer(x_out, y_out, tile_ids)), caps
+
+    def _map_layer_tiles(
+        self, *, z: int, full_map: bool
+    ) -> Tuple[RenderLayer, np.ndarray, np.ndarray, np.ndarray]:
+        """Returns the border tiles of a single layer of the map, and the y, x and tile id of every tile it draws within the map's bounds."""
+        x_origin, y_origin, x_max, y_max = self.get_bounds(full_map=full_map)
+
+        # the part of the view that's within the map's bounds, empty if there isn't any
+        top = max(y_origin, 0)
+        left = max(x_origin, 0)
+        bottom = max(min(y_max, self.rows), top)
+        right = max(min(x_max, self.cols), left)
+
+        # blank tiles are the default tile, which is already on the image
+        view = self._grid[z, top:bottom, left:right]
+        y, x = np.nonzero(view != self._blank_id)
+        tile_ids = view[y, x]
+
+        # everything outside of the map's bounds is the border tile, only for the first layer
+        out_of_bounds = np.full((y_max - y_origin, x_max - x_origin), z == 0)
+        out_of_bounds[
+            top - y_origin : bottom - y_origin, left - x_origin : right - x_origin
+        ] = False
+        border_y, border_x = np.nonzero(out_of_bounds)
+        border = _make_layer(
+            border_x * TILE_SIZE,
+            border_y * TILE_SIZE,
+            np.full(len(border_x), self.get_tile_id(self.map["border"])),
+            out_of_bounds=True,
+        )
+
+        return border, y + top, x + left, tile_ids
 
     def tile_mapper(self, *, full_map: bool = False):
         """Generates tiles for the map."""
         # we'll be adding tiles to a dictionary on a per-layer basis.
         # this allows us to have more flexibility in how we render the map
-        if full_map:
-            x_origin = 0
-            y_origin = 0
-            x_max = self.cols
-            y_max = self.rows
-        else:
-            x_origin = -self.radius + self.x
-            y_origin = -self.radius + self.y
-            x_max = self.radius + self.x + 1
-            y_max = self.radius + self.y + 1
-
-        layers: DefaultDict[int, List[RenderTile]] = defaultdict(list)
-
-        for z_index in range(len(self.map["layers"])):
-            for x, y in itertools.product(
-                range(x_origin, x_max), range(y_origin, y_max)
-            ):
-                out_of_bounds = x < 0 or y < 0 or x >= self.cols or y >= self.rows
-
-                x_out = (x - x_origin) * TILE_SIZE
-                y_out = (y - y_origin) * TILE_SIZE
-
-                if z_index == 0 and out_of_bounds:
-                    layers[z_index].append(
-                        RenderTile(
-                            x=x_out,
-                            y=y_out,
-                            z=z_index,
-                            tile=self.map["border"],
-                            out_of_bounds=True,
-                        )
-                    )
-                    continue
-
-                if out_of_bounds:
-                    continue
-
-                tile = self.map["layers"][z_index][y][x]
-                if tile == " ":
-                    continue
-
-                if self.render_water_edges is False:
-                    continue
-
-                tile_name = self.map["tiles"].get(tile)
-                if tile_name == "wtr":
-                    # special cases for water edges below
-                    # this is not particularly fast when doing a full map render, like of an overworld.
-                    # when the visibility is a normal amount it's fast enough
-                    # ...but overengineering it is not worth it IMO
-                    neighbors = self.get_neighbors(x=x, y=y, z=z_index)
-                    water_lookup = {0: "n", 1: "s", 2: "e", 3: "w"}
-                    water_edges: List[str] = []
-                    for index, neighbor in enumerate(neighbors[:4]):
-                        if neighbor.out_of_bounds:
-                            # this tile is adjacent to water, and is out of bounds, so we assume it would also be water
-                            tile_name = "wtr"
-                        else:
-                            tile_name = (
-                                self.map["tiles"].get(neighbor.tile)
-                                or self.map["tiles"][self.map["default"]]
-                            )
-                        if tile_name not in WATER_EDGE_CANCELERS:
-                            water_edges.append(water_lookup[index])
-
-                    edges_str = "".join(water_edges)
-                    if edges_str:
-                        tile = f"wtr_{edges_str}"
-
-                    # the following code is for the "caps" of water edges
-                    # for example, if the tile we're currently on is water, and there's a water tile both to the east and south,
-                    # then we'll put a cap where those edges meet to have a clean look, just like NQ2 does!
-
-                    ordinal = neighbors[4:]  # NW, SW, SE, NE in that order
-                    # we'll make new layers for each
-                    for index, edge_letter in enumerate("acdb"):
-                        if ordinal[index].out_of_bounds:
-                            # this water is out of bounds, so we don't add a corner
-                            continue
-
-                        tile_name = (
-                            self.map["tiles"].get(ordinal[index].tile)
-                            or self.map["tiles"][self.map["default"]]
-                        )
-
-                        if tile_name not in WATER_EDGE_CANCELERS:
-                            layers[len(layers) + 1].append(
-                                RenderTile(
-                                    x=x_out,
-                                    y=y_out,
-                                    z=z_index,
-                                    tile=f"wtrc_{edge_letter}",
-                                )
-                            )
-
-                layers[z_index].append(
-                    RenderTile(x=x_out, y=y_out, z=z_index, tile=tile)
-                )
+        # layers get rendered in the order they're added, not by their key
+        layers: Dict[int, RenderLayer] = {}
+
+        # water edge caps get a layer per corner, keyed after all of the map's layers.
+        # that way caps on the same tile never overlap within a layer
+        caps_z = len(self.map["layers"])
+        for z_index in range(caps_z):
+            tiles, caps = self.map_layer(z=z_index, full_map=full_map)
+            layers[z_index] = tiles
+            # right on top of the layer they're for
+            for corner, corner_caps in enumerate(caps):
+                if len(corner_caps["x"]):
+                    layers[caps_z + z_index * len(caps) + corner] = corner_caps
 
         return layers
 
-    def render(self, *, full_map: bool = False):
-        """Renders the map. If full_map is True, the entire map will be rendered, otherwise it will be what's visible using the visibility + x + y attributes."""
+    def get_cache_path(self, *, full_map: bool = False) -> Path:
+        """Returns where a render of the map with these settings gets cached."""
+        if full_map:
+            view: Tuple[Any, ...] = ("full",)
+        else:
+            view = (self.x, self.y, self.visibility)
+        key = (
+            RENDER_VERSION,
+            self.map_id,
+            self._map_mtime,
+            *view,
+            self.render_water_edges,
+        )
+        digest = hashlib.blake2b(repr(key).encode(), digest_size=16).hexdigest()
+        return CACHE_FOLDER / f"{digest}.png"
+
+    def render(self, *, full_map: bool = False, cache: bool = False):
+        """Renders the map. If full_map is True, the entire map will be rendered, otherwise it will be what's visible using the visibility + x + y attributes.
+        If cache is True, a previous render with the same settings gets reused, and this one gets saved for next time.
+        """
+        if cache:
+            cache_path = self.get_cache_path(full_map=full_map)
+            if cache_path.exists():
+                return BytesIO(cache_path.read_bytes())
+
         map_bytes = BytesIO()
 
+        tiles = self.tile_mapper(full_map=full_map)
+
+        # every tile this render draws
+        used_ids = np.unique(
+            np.concatenate([layer["tile_id"] for layer in tiles.values()])
+        ).tolist()
+
+        # rather than one at a time as they come up. only the ones that get drawn,
+        # the rest of the tiles the map could use might not even exist
+        self.download_tiles(used_ids)
+
         if full_map:
             image_size = (self.cols * TILE_SIZE, self.rows * TILE_SIZE)
         else:
             image_size = (self.visibility * TILE_SIZE, self.visibility * TILE_SIZE)
 
-        base_image = Image.new("RGBA", image_size)
+        # make a base layer with default background tiles, all in one go
+        # the whole image is built up in this one RGBA buffer, rows first, like PIL lays it out
+        canvas = np.tile(
+            self.get_tile_array(self.map["default"]),
+            (image_size[1] // TILE_SIZE, image_size[0] // TILE_SIZE, 1),
+        )
 
-        # make a base layer with default background tiles
-        for x, y in itertools.product(
-            range(0, image_size[0], TILE_SIZE), range(0, image_size[1], TILE_SIZE)
-        ):
-            base_image.paste(self.get_tile(self.map["default"]), (x, y))
+        # the same buffer, as a grid of (row, TILE_SIZE, col, TILE_SIZE) tile spots.
+        # a whole batch of spots can be written with one assignment this way, rather than one slice per tile
+        grid_shape = (
+            image_size[1] // TILE_SIZE,
+            TILE_SIZE,
+            image_size[0] // TILE_SIZE,
+            TILE_SIZE,
+            4,
+        )
+        spots = canvas.reshape(grid_shape)
+
+        # every tile image this render uses, stacked into one (tiles, TILE_SIZE, TILE_SIZE, 4) atlas
+        atlas = np.zeros((len(used_ids), TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8)
+        for index, tile_id in enumerate(used_ids):
+            atlas[index] = _load_tile_array(self.tile_names_by_id[tile_id])
+        atlas_opaque = np.array(
+            [_is_tile_opaque(self.tile_names_by_id[tile_id]) for tile_id in used_ids],
+            dtype=bool,
+        )
+        # tile id -> index in the atlas
+        atlas_indexes = np.zeros(len(self.tile_names_by_id), dtype=np.intp)
+        atlas_indexes[used_ids] = np.arange(len(used_ids))
+
+        for layer in tiles.values():
+            # tiles in a layer never overlap, so they all go straight onto the image at once, no layer buffer needed.
+            # that goes for out of bounds tiles too, only the spots a tile lands on ever get blended
+            rows = layer["y"] // TILE_SIZE
+            cols = layer["x"] // TILE_SIZE
+            indexes = atlas_indexes[layer["tile_id"]]
+
+            # opaque tiles just get copied over what's under them, only see-through ones need blending
+            opaque = atlas_opaque[indexes]
+            spots[rows[opaque], :, cols[opaque]] = atlas[indexes[opaque]]
+
+            see_through = ~opaque
+            if see_through.any():
+                rows = rows[see_through]
+                cols = cols[see_through]
+                # blended by PIL in one go, with the spots stacked on top of each other as one tall image
+                blended = Image.alpha_composite(
+                    Image.fromarray(spots[rows, :, cols].reshape(-1, TILE_SIZE, 4)),
+                    Image.fromarray(
+                        atlas[indexes[see_through]].reshape(-1, TILE_SIZE, 4)
+                    ),
+                )
+                spots[rows, :, cols] = np.asarray(blended).reshape(
+                    -1, TILE_SIZE, TILE_SIZE, 4
+                )
 
-        tiles = self.tile_mapper(full_map=full_map)
-        out_of_bounds_layer = Image.new("RGBA", image_size)
-        for z_index, layer in tiles.items():
-            layer_image = Image.new("RGBA", image_size)
-            for tile in layer:
-                if tile.out_of_bounds:
-                    out_of_bounds_layer.paste(
-                        self.get_tile(tile.tile), (tile.x, tile.y)
-                    )
-                    continue
-                layer_image.paste(self.get_tile(tile.tile), (tile.x, tile.y))
-
-            if z_index == 0:
-                base_image.alpha_composite(out_of_bounds_layer)
-            base_image.alpha_composite(layer_image)
-
-        base_image.save(map_bytes, format="PNG")
+        base_image = Image.fromarray(canvas)
+        # encoding is on the way of every render that isn't cached, so favor its speed over size
+        base_image.save(map_bytes, format="PNG", compress_level=1)
         map_bytes.seek(0)
+
+        if cache:
+            CACHE_FOLDER.mkdir(exist_ok=True)
+            # written to a temporary file first and moved into place, so other renders never read a partial one
+            with tempfile.NamedTemporaryFile(
+                dir=CACHE_FOLDER, suffix=".tmp", delete=False
+            ) as cache_file:
+                cache_file.write(map_bytes.getvalue())
+            os.replace(cache_file.name, cache_path)
+
         return map_bytes